@@ -9,22 +9,48 @@ import grp
 import pyinotify
 import time
 import socket
+import ipaddress
 import logging
 import yaml
 import subprocess
 import psutil
 
 class Application():
-  def __init__(self, logfile='/var/log/poweroffd', monitor_path='/run/poweroffd'):
+  def __init__(self, logfile=None, monitor_path=None):
     self.started_monitor = False
     # key: filename
     # value: [IP, TIMEOUT]
     self.monitor_hash = {}
     self.erroneous_files = set()
+    if logfile == None:
+      logfile = os.getenv('LOGFILE', '/var/log/poweroffd')
+    if monitor_path == None:
+      monitor_path = os.getenv('MONITOR_PATH', '/run/poweroffd')
     self.LOGFILE = logfile
     self.MONITOR_PATH = monitor_path
     self.LOGLEVEL = os.getenv('LOGLEVEL', 'INFO').upper()
     self.POWEROFF_COMMAND = os.getenv('POWEROFF_COMMAND', '/usr/sbin/poweroff')
+    # aggregator mode: nodes push their idle/busy state to AGGREGATOR_ADDRESS,
+    # the coordinator listens on AGGREGATOR_LISTEN
+    self.AGGREGATOR_ADDRESS = os.getenv('AGGREGATOR_ADDRESS', '')
+    self.AGGREGATOR_LISTEN = os.getenv('AGGREGATOR_LISTEN', '')
+    # comma separated networks from which UDP node messages are accepted
+    self.AGGREGATOR_ALLOW = os.getenv('AGGREGATOR_ALLOW', '')
+    self.allowed_networks = []
+    self.NODE_NAME = os.getenv('NODE_NAME', socket.gethostname())
+    self.HEARTBEAT_INTERVAL = os.getenv('HEARTBEAT_INTERVAL', '10')
+    # number of heartbeats a node may miss before the aggregator forgets it
+    self.HEARTBEAT_MISSES = 3
+    self.node_socket = None
+    self.node_address = None
+    self.reporting_disabled = False
+    self.reported_state = None
+    self.reported_time = 0
+    self.aggregator_socket = None
+    # key: node name
+    # value: [STATE, LAST_SEEN, INTERVAL]
+    self.node_hash = {}
+    self.busy_nodes = set()
 
   def setup(self):
     if self.LOGLEVEL not in ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']:
@@ -33,6 +59,14 @@ class Application():
     else:
       logging.basicConfig(filename=self.LOGFILE, level=eval("logging."+self.LOGLEVEL), datefmt='%Y-%m-%d %H:%M:%S %Z', format='[%(asctime)s] %(levelname)s %(message)s')
 
+    try:
+      self.HEARTBEAT_INTERVAL = int(self.HEARTBEAT_INTERVAL)
+      if self.HEARTBEAT_INTERVAL <= 0:
+        raise ValueError()
+    except ValueError:
+      logging.warning("Invalid heartbeat interval " + str(self.HEARTBEAT_INTERVAL) + ". Defaulting to 10.")
+      self.HEARTBEAT_INTERVAL = 10
+
     logging.debug("Poweroff command: " + self.POWEROFF_COMMAND)
     logging.debug("Path to monitor: " + self.MONITOR_PATH)
     if not os.path.isdir(self.MONITOR_PATH):
@@ -48,6 +82,53 @@ class Application():
     self.notifier = pyinotify.Notifier(wm, self.inotify_event_handler)
     wm.add_watch(self.MONITOR_PATH, pyinotify.IN_CLOSE_WRITE | pyinotify.IN_DELETE)
 
+    if self.AGGREGATOR_ADDRESS:
+      # the name has to be a single token and the message has to fit in what the aggregator reads
+      message = 'poweroffd ' + self.NODE_NAME + ' busy ' + str(self.HEARTBEAT_INTERVAL)
+      if not self.NODE_NAME.isascii() or not self.NODE_NAME.isprintable() or ' ' in self.NODE_NAME \
+          or len(self.NODE_NAME) == 0 or len(message) > 512:
+        logging.error("Invalid node name " + repr(self.NODE_NAME) + ". Set NODE_NAME to a single word of printable ASCII characters. Not reporting state.")
+        self.reporting_disabled = True
+      else:
+        logging.debug("Reporting state as node " + self.NODE_NAME + " to " + self.AGGREGATOR_ADDRESS)
+
+    if self.AGGREGATOR_LISTEN:
+      try:
+        (family, address) = _parse_address(self.AGGREGATOR_LISTEN)
+      except (ValueError, OSError) as e:
+        logging.critical("Invalid aggregator listen address " + self.AGGREGATOR_LISTEN + ": " + str(e))
+        raise
+      logging.debug("Listening for node states on " + self.AGGREGATOR_LISTEN)
+      if family == socket.AF_UNIX and os.path.exists(address):
+        if not stat.S_ISSOCK(os.stat(address).st_mode):
+          logging.critical("Not listening on " + address + " since it exists and is not a socket")
+          raise FileExistsError("Not a socket: " + address)
+        # only a socket nobody is bound to anymore is stale
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+          probe.connect(address)
+          logging.critical("Not listening on " + address + " since another aggregator is using it")
+          raise FileExistsError("Socket in use: " + address)
+        except ConnectionRefusedError:
+          # stale socket of a previous run
+          os.unlink(address)
+        finally:
+          probe.close()
+      for network in self.AGGREGATOR_ALLOW.split(','):
+        if network.strip() == '':
+          continue
+        try:
+          self.allowed_networks.append(ipaddress.ip_network(network.strip(), strict=False))
+        except ValueError as e:
+          # silently skipping would widen the allow-list
+          logging.critical("Invalid network in AGGREGATOR_ALLOW: " + str(e))
+          raise
+      if family != socket.AF_UNIX and len(self.allowed_networks) == 0:
+        logging.warning("Accepting node states from any host. Set AGGREGATOR_ALLOW to restrict this.")
+      self.aggregator_socket = socket.socket(family, socket.SOCK_DGRAM)
+      self.aggregator_socket.bind(address)
+      self.aggregator_socket.setblocking(False)
+
     logging.info("Setup finished")
 
   def _get_process_dict(self, pid):
@@ -199,14 +280,129 @@ class Application():
           logging.info("Removing file " + f + " due completion of PID " + str(pid) + " (" + pid_info['name'] + ")")
           self._remove_entry(f)
 
+  def _report_state(self):
+    """
+    Send our idle/busy state to the aggregator.
+
+    The state is sent when it changes and at least every HEARTBEAT_INTERVAL seconds
+    so the aggregator knows we are still around.
+
+    The aggregator address is only resolved here so a name which can't be resolved yet
+    (e.g. network not up at boot) is retried on the next round instead of stopping the daemon.
+    """
+    if not self.AGGREGATOR_ADDRESS or self.reporting_disabled:
+      return
+    if len(self.monitor_hash) > 0:
+      state = 'busy'
+    else:
+      state = 'idle'
+    now = time.time()
+    if state == self.reported_state and now - self.reported_time < self.HEARTBEAT_INTERVAL:
+      return
+    message = 'poweroffd ' + self.NODE_NAME + ' ' + state + ' ' + str(self.HEARTBEAT_INTERVAL)
+    try:
+      if self.node_socket == None:
+        (family, self.node_address) = _parse_address(self.AGGREGATOR_ADDRESS)
+        self.node_socket = socket.socket(family, socket.SOCK_DGRAM)
+        # never wait for an aggregator which isn't reading
+        self.node_socket.setblocking(False)
+      self.node_socket.sendto(message.encode('ascii'), self.node_address)
+    except ValueError as e:
+      # malformed address or a host name which can't be IDNA encoded (UnicodeError).
+      # Retrying won't help.
+      logging.error("Invalid aggregator address " + self.AGGREGATOR_ADDRESS + ": " + str(e) + ". Not reporting state.")
+      self.reporting_disabled = True
+      return
+    except BlockingIOError:
+      logging.debug("Aggregator " + self.AGGREGATOR_ADDRESS + " is not reading. Retrying on the next round.")
+      return
+    except OSError as e:
+      # name not resolvable (yet) or the aggregator not up (yet). Resolve again and retry on the next round.
+      logging.debug("Could not report state to " + self.AGGREGATOR_ADDRESS + ": " + str(e))
+      if self.node_socket != None:
+        self.node_socket.close()
+        self.node_socket = None
+      return
+    if state != self.reported_state:
+      logging.info("Reported state " + state + " to " + self.AGGREGATOR_ADDRESS)
+    self.reported_state = state
+    self.reported_time = now
+
+  def _process_node_messages(self):
+    """
+    Read all pending state messages of the nodes and update the membership table.
+
+    A message looks like 'poweroffd NODE_NAME STATE INTERVAL' where STATE is either idle or busy
+    and INTERVAL the heartbeat interval of the node in seconds. Malformed messages and, for UDP,
+    messages from outside AGGREGATOR_ALLOW are ignored.
+    """
+    if self.aggregator_socket == None:
+      return
+    while True:
+      try:
+        (data, sender) = self.aggregator_socket.recvfrom(512)
+      except (BlockingIOError, InterruptedError):
+        break
+      if not self._is_allowed(sender):
+        logging.debug("Ignoring node message from " + str(sender))
+        continue
+      fields = data.decode('ascii', 'replace').split()
+      if len(fields) != 4 or fields[0] != 'poweroffd' or fields[2] not in ['idle', 'busy'] \
+          or not fields[3].isdigit() or int(fields[3]) == 0:
+        # debug only: anybody able to reach the socket can send these
+        logging.debug("Ignoring malformed node message " + repr(data))
+        continue
+      (node, state, interval) = fields[1:]
+      if node not in self.node_hash or self.node_hash[node][0] != state:
+        logging.info("Node " + node + " is " + state)
+      self.node_hash[node] = [state, time.time(), int(interval)]
+      if state == 'busy':
+        self.busy_nodes.add(node)
+        self.started_monitor = True
+      else:
+        self.busy_nodes.discard(node)
+
+  def _is_allowed(self, sender):
+    if self.aggregator_socket.family == socket.AF_UNIX or len(self.allowed_networks) == 0:
+      # unix sockets are protected by their file permissions
+      return True
+    ip = ipaddress.ip_address(sender[0].split('%')[0])
+    if ip.version == 6 and ip.ipv4_mapped != None:
+      ip = ip.ipv4_mapped
+    for network in self.allowed_networks:
+      if ip in network:
+        return True
+    return False
+
+  def _check_nodes(self):
+    """
+    Drop the nodes which missed HEARTBEAT_MISSES heartbeats.
+
+    Each node is judged on the heartbeat interval it reported itself, so nodes
+    and aggregator don't need to share the same HEARTBEAT_INTERVAL.
+    """
+    current_epoch = time.time()
+    for node in list(self.node_hash):
+      (state, last_seen, interval) = self.node_hash[node]
+      if current_epoch - last_seen > self.HEARTBEAT_MISSES * interval:
+        logging.info("Removing node " + node + " (" + state + ") since its heartbeat expired")
+        del self.node_hash[node]
+        self.busy_nodes.discard(node)
+
+  def _is_idle(self):
+    return self.started_monitor == True and len(self.monitor_hash) == 0 and len(self.busy_nodes) == 0
+
   def run(self):
     while True:
       self._process_inotify_events()
+      self._process_node_messages()
 
       self._check_hosts()
       self._check_timeouts()
       self._check_pids()
-      if self.started_monitor == True and len(self.monitor_hash) == 0:
+      self._check_nodes()
+      self._report_state()
+      if self._is_idle():
         if self._poweroff():
           # executing poweroff succeeded.
           break
@@ -219,6 +415,32 @@ class Application():
     subprocess.call([self.POWEROFF_COMMAND], shell=True)
     return True
 
+def _parse_address(address):
+  """
+  Convert an aggregator address into a (socket family, socket address) tuple.
+
+  Addresses starting with a / are unix datagram sockets. Other addresses are
+  of the form HOST:PORT and use UDP over IPv4, or [HOST]:PORT for IPv6. The family
+  isn't left to the resolver so nodes and aggregator agree on it. An empty HOST
+  means all interfaces.
+  A ValueError is raised for malformed addresses.
+  """
+  if address.startswith('/'):
+    return (socket.AF_UNIX, address)
+  if ':' not in address:
+    raise ValueError("expected HOST:PORT or an absolute path")
+  (host, port) = address.rsplit(':', 1)
+  family = socket.AF_INET
+  if host.startswith('[') and host.endswith(']'):
+    family = socket.AF_INET6
+    host = host[1:-1]
+  if not port.isdigit() or int(port) > 65535:
+    raise ValueError("invalid port " + port)
+  if host == '':
+    host = None
+  info = socket.getaddrinfo(host, int(port), family, socket.SOCK_DGRAM, 0, socket.AI_PASSIVE)[0]
+  return (info[0], info[4])
+
 class PoweroffdEventHandler(pyinotify.ProcessEvent):
   def __init__(self, app):
     pyinotify.ProcessEvent.__init__(self)
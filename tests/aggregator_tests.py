@@ -0,0 +1,394 @@
+#! /usr/bin/env python
+# vim: set ai softtabstop=2 shiftwidth=2 tabstop=80 textwidth=180 :
+
+import os
+import sys
+import time
+from threading import Timer
+import logging
+import tempfile
+import subprocess
+import threading
+
+import pytest
+
+import poweroffd
+
+timeout_config = """---
+  start_time: NOW
+  poweroff_on:
+    timeout: 30
+"""
+
+def make_app(tmpdir, name):
+  def noop():
+    pass
+
+  os.environ['LOGLEVEL'] = 'DEBUG'
+  os.environ['POWEROFF_COMMAND'] = '/bin/true'
+  appl = poweroffd.Application(logfile=str(tmpdir.join('logfile')), monitor_path=str(tmpdir.join(name)))
+  appl._set_monitor_path_permissions = noop
+  appl.NODE_NAME = name
+  return appl
+
+@pytest.fixture
+def coordinator(tmpdir):
+  rootlogger = logging.getLogger()
+  # ensure we log in the correct directory
+  for h in rootlogger.handlers:
+    rootlogger.removeHandler(h)
+  appl = make_app(tmpdir, 'coordinator')
+  appl.AGGREGATOR_LISTEN = str(tmpdir.join('aggregator.sock'))
+  appl.setup()
+  return appl
+
+@pytest.fixture
+def nodes(tmpdir, coordinator):
+  appls = []
+  for name in ['node1', 'node2']:
+    appl = make_app(tmpdir, name)
+    appl.AGGREGATOR_ADDRESS = coordinator.AGGREGATOR_LISTEN
+    appl.setup()
+    appls.append(appl)
+  return appls
+
+@pytest.fixture
+def udp_coordinator(tmpdir):
+  rootlogger = logging.getLogger()
+  for h in rootlogger.handlers:
+    rootlogger.removeHandler(h)
+  appl = make_app(tmpdir, 'coordinator')
+  appl.AGGREGATOR_LISTEN = '127.0.0.1:0'
+  return appl
+
+def udp_node(tmpdir, coordinator, name):
+  appl = make_app(tmpdir, name)
+  appl.AGGREGATOR_ADDRESS = '127.0.0.1:' + str(coordinator.aggregator_socket.getsockname()[1])
+  appl.setup()
+  return appl
+
+def create_timeout_file(tmpdir, name, now):
+  (handle, fname) = tempfile.mkstemp(dir=str(tmpdir.join(name)), prefix='timeout_config', suffix='.conf', text=True)
+  handle = os.fdopen(handle, 'w')
+  handle.write(timeout_config.replace('start_time: NOW', 'start_time: '+str(int(now))))
+  handle.close()
+  return fname
+
+@pytest.mark.quick
+def test_parse_address():
+  assert poweroffd._parse_address('/run/poweroffd.sock') == (poweroffd.socket.AF_UNIX, '/run/poweroffd.sock')
+  (family, address) = poweroffd._parse_address('127.0.0.1:7070')
+  assert family == poweroffd.socket.AF_INET
+  assert address == ('127.0.0.1', 7070)
+  (family, address) = poweroffd._parse_address('[::1]:7070')
+  assert family == poweroffd.socket.AF_INET6
+  assert address[:2] == ('::1', 7070)
+  # host names resolve to IPv4 unless between square brackets
+  (family, address) = poweroffd._parse_address('localhost:7070')
+  assert family == poweroffd.socket.AF_INET
+  assert address == ('127.0.0.1', 7070)
+  (family, address) = poweroffd._parse_address('[]:7070')
+  assert family == poweroffd.socket.AF_INET6
+  assert address[:2] == ('::', 7070)
+
+@pytest.mark.quick
+def test_udp_round_trip(tmpdir, udp_coordinator):
+  udp_coordinator.setup()
+  assert udp_coordinator.aggregator_socket.getsockname()[1] != 0
+  nodes = [udp_node(tmpdir, udp_coordinator, 'node1'), udp_node(tmpdir, udp_coordinator, 'node2')]
+  nodes[0].read_config(create_timeout_file(tmpdir, 'node1', int(time.time())))
+  for node in nodes:
+    node._report_state()
+    assert node.node_socket.family == poweroffd.socket.AF_INET
+  time.sleep(0.1)
+  udp_coordinator._process_node_messages()
+  assert udp_coordinator.node_hash['node1'][0] == 'busy'
+  assert udp_coordinator.node_hash['node2'][0] == 'idle'
+  assert udp_coordinator.busy_nodes == set(['node1'])
+
+  nodes[0].monitor_hash = {}
+  nodes[0]._report_state()
+  time.sleep(0.1)
+  udp_coordinator._process_node_messages()
+  assert udp_coordinator.busy_nodes == set()
+  assert udp_coordinator._is_idle() == True
+
+@pytest.mark.quick
+def test_listen_on_stale_socket(tmpdir):
+  # a socket left behind by a previous run is replaced
+  address = str(tmpdir.join('aggregator.sock'))
+  sock = poweroffd.socket.socket(poweroffd.socket.AF_UNIX, poweroffd.socket.SOCK_DGRAM)
+  sock.bind(address)
+  sock.close()
+  appl = make_app(tmpdir, 'coordinator')
+  appl.AGGREGATOR_LISTEN = address
+  appl.setup()
+  assert appl.aggregator_socket != None
+
+@pytest.mark.quick
+def test_listen_on_socket_in_use(tmpdir, coordinator, nodes):
+  appl = make_app(tmpdir, 'coordinator2')
+  appl.AGGREGATOR_LISTEN = coordinator.AGGREGATOR_LISTEN
+  with pytest.raises(FileExistsError):
+    appl.setup()
+  # the running aggregator still receives the node states
+  nodes[0]._report_state()
+  coordinator._process_node_messages()
+  assert 'node1' in coordinator.node_hash
+
+@pytest.mark.quick
+def test_listen_on_regular_file(tmpdir):
+  tmpdir.join('aggregator.conf').write('keep me')
+  appl = make_app(tmpdir, 'coordinator')
+  appl.AGGREGATOR_LISTEN = str(tmpdir.join('aggregator.conf'))
+  with pytest.raises(FileExistsError):
+    appl.setup()
+  assert tmpdir.join('aggregator.conf').read() == 'keep me'
+
+@pytest.mark.quick
+def test_nodes_report_state(tmpdir, coordinator, nodes):
+  now = int(time.time())
+  nodes[0].read_config(create_timeout_file(tmpdir, 'node1', now))
+  for node in nodes:
+    node._report_state()
+  coordinator._process_node_messages()
+  assert set(coordinator.node_hash) == set(['node1', 'node2'])
+  assert coordinator.node_hash['node1'][0] == 'busy'
+  assert coordinator.node_hash['node2'][0] == 'idle'
+  assert coordinator.busy_nodes == set(['node1'])
+  assert coordinator.started_monitor == True
+  assert coordinator._is_idle() == False
+
+  nodes[0].monitor_hash = {}
+  nodes[0]._report_state()
+  coordinator._process_node_messages()
+  assert coordinator.busy_nodes == set()
+  assert coordinator._is_idle() == True
+
+@pytest.mark.quick
+def test_state_only_resent_on_change_or_heartbeat(coordinator, nodes):
+  nodes[0]._report_state()
+  reported_time = nodes[0].reported_time
+  nodes[0]._report_state()
+  assert nodes[0].reported_time == reported_time
+  nodes[0].HEARTBEAT_INTERVAL = 0
+  nodes[0]._report_state()
+  assert nodes[0].reported_time > reported_time
+
+@pytest.mark.quick
+def test_idle_nodes_do_not_start_monitor(coordinator, nodes):
+  for node in nodes:
+    node._report_state()
+  coordinator._process_node_messages()
+  assert len(coordinator.node_hash) == 2
+  assert coordinator.started_monitor == False
+  assert coordinator._is_idle() == False
+
+@pytest.mark.quick
+def test_malformed_message(coordinator):
+  sock = poweroffd.socket.socket(poweroffd.socket.AF_UNIX, poweroffd.socket.SOCK_DGRAM)
+  for message in [b'garbage', b'poweroffd node1 sleeping 10', b'poweroffd node1 busy', b'poweroffd node1 busy 0']:
+    sock.sendto(message, coordinator.AGGREGATOR_LISTEN)
+  sock.close()
+  coordinator._process_node_messages()
+  assert coordinator.node_hash == {}
+
+@pytest.mark.quick
+def test_heartbeat_expired(tmpdir, coordinator, nodes):
+  now = int(time.time())
+  nodes[0].read_config(create_timeout_file(tmpdir, 'node1', now))
+  nodes[0]._report_state()
+  coordinator._process_node_messages()
+  assert coordinator.busy_nodes == set(['node1'])
+  coordinator._check_nodes()
+  assert coordinator.busy_nodes == set(['node1'])
+  coordinator.node_hash['node1'][1] -= coordinator.HEARTBEAT_MISSES * nodes[0].HEARTBEAT_INTERVAL + 1
+  coordinator._check_nodes()
+  assert coordinator.node_hash == {}
+  assert coordinator.busy_nodes == set()
+  assert coordinator._is_idle() == True
+
+@pytest.mark.quick
+def test_heartbeat_interval_of_node(tmpdir, coordinator, nodes):
+  now = int(time.time())
+  nodes[0].HEARTBEAT_INTERVAL = 6 * coordinator.HEARTBEAT_INTERVAL
+  nodes[0].read_config(create_timeout_file(tmpdir, 'node1', now))
+  nodes[0]._report_state()
+  coordinator._process_node_messages()
+  assert coordinator.node_hash['node1'][2] == nodes[0].HEARTBEAT_INTERVAL
+  # silent for longer than the aggregator's own heartbeats would allow
+  coordinator.node_hash['node1'][1] -= coordinator.HEARTBEAT_MISSES * coordinator.HEARTBEAT_INTERVAL + 1
+  coordinator._check_nodes()
+  assert coordinator.busy_nodes == set(['node1'])
+  assert coordinator._is_idle() == False
+  coordinator.node_hash['node1'][1] -= coordinator.HEARTBEAT_MISSES * nodes[0].HEARTBEAT_INTERVAL
+  coordinator._check_nodes()
+  assert coordinator.busy_nodes == set()
+
+@pytest.mark.quick
+def test_aggregator_not_listening(tmpdir):
+  node = make_app(tmpdir, 'node1')
+  node.AGGREGATOR_ADDRESS = str(tmpdir.join('nobody.sock'))
+  node.setup()
+  node._report_state()
+  assert node.reported_state == None
+  assert node.node_socket == None
+  assert node.reporting_disabled == False
+
+@pytest.mark.quick
+def test_aggregator_not_reading(tmpdir):
+  address = str(tmpdir.join('aggregator.sock'))
+  sock = poweroffd.socket.socket(poweroffd.socket.AF_UNIX, poweroffd.socket.SOCK_DGRAM)
+  sock.bind(address)
+  node = make_app(tmpdir, 'node1')
+  node.AGGREGATOR_ADDRESS = address
+  node.setup()
+  node.HEARTBEAT_INTERVAL = 0
+  def report():
+    # far more than the receive queue of the socket can hold
+    for i in range(1000):
+      node._report_state()
+  t = threading.Thread(target=report)
+  t.daemon = True
+  t.start()
+  t.join(10)
+  sock.close()
+  assert not t.is_alive()
+  assert node.reported_state == 'idle'
+
+@pytest.mark.quick
+def test_aggregator_not_resolvable(tmpdir):
+  node = make_app(tmpdir, 'node1')
+  node.AGGREGATOR_ADDRESS = 'nonexistent.invalid:7070'
+  node.setup()
+  node._report_state()
+  assert node.reported_state == None
+  assert node.node_socket == None
+  # retried on the next round
+  assert node.reporting_disabled == False
+
+@pytest.mark.quick
+@pytest.mark.parametrize('address', ['head', 'head:', 'head:port', 'head:70000', 'a'*70 + '.example:7070'])
+def test_aggregator_address_malformed(tmpdir, address):
+  node = make_app(tmpdir, 'node1')
+  node.AGGREGATOR_ADDRESS = address
+  node.setup()
+  node._report_state()
+  assert node.reported_state == None
+  assert node.reporting_disabled == True
+
+@pytest.mark.quick
+@pytest.mark.parametrize('name', ['my node', 'n\u00f6de', '', 'x' * 500])
+def test_node_name_invalid(tmpdir, coordinator, caplog, name):
+  node = make_app(tmpdir, 'node1')
+  node.NODE_NAME = name
+  node.AGGREGATOR_ADDRESS = coordinator.AGGREGATOR_LISTEN
+  node.setup()
+  assert node.reporting_disabled == True
+  node._report_state()
+  assert node.reported_state == None
+  assert 'Invalid node name' in caplog.text
+
+@pytest.mark.quick
+@pytest.mark.parametrize('interval', ['abc', '0', '-5'])
+def test_heartbeat_interval_invalid(tmpdir, interval):
+  node = make_app(tmpdir, 'node1')
+  node.HEARTBEAT_INTERVAL = interval
+  node.setup()
+  assert node.HEARTBEAT_INTERVAL == 10
+
+@pytest.mark.semi_quick
+def test_poweroff_when_nodes_idle(tmpdir, coordinator, nodes):
+  def _emergency_break():
+    coordinator.__EMERGENCY_APPLIED__ = True
+    coordinator.busy_nodes = set()
+
+  def _node_done():
+    nodes[0].monitor_hash = {}
+    nodes[0]._report_state()
+
+  now = int(time.time())
+  nodes[0].read_config(create_timeout_file(tmpdir, 'node1', now))
+  nodes[0]._report_state()
+  t1 = Timer(1, _node_done, ())
+  t2 = Timer(4, _emergency_break, ())
+  t1.start()
+  t2.start()
+  coordinator.__EMERGENCY_APPLIED__ = False
+  coordinator.run()
+  # application returned fine, cancel the timer now
+  t2.cancel()
+  assert coordinator.__EMERGENCY_APPLIED__ == False
+  assert coordinator.node_hash['node1'][0] == 'idle'
+
+@pytest.mark.quick
+def test_paths_from_environment(tmpdir, monkeypatch):
+  monkeypatch.setenv('LOGFILE', str(tmpdir.join('node1.log')))
+  monkeypatch.setenv('MONITOR_PATH', str(tmpdir.join('node1')))
+  appl = poweroffd.Application()
+  assert appl.LOGFILE == str(tmpdir.join('node1.log'))
+  assert appl.MONITOR_PATH == str(tmpdir.join('node1'))
+
+def start_daemon(tmpdir, name, **settings):
+  env = dict(os.environ)
+  env.update(settings)
+  env['LOGLEVEL'] = 'DEBUG'
+  env['LOGFILE'] = str(tmpdir.join(name+'.log'))
+  env['MONITOR_PATH'] = str(tmpdir.join(name))
+  env['NODE_NAME'] = name
+  env['POWEROFF_COMMAND'] = 'touch ' + str(tmpdir.join(name+'.poweroff'))
+  return subprocess.Popen([sys.executable, poweroffd.__file__], env=env)
+
+@pytest.mark.semi_quick
+def test_daemons_on_one_host(tmpdir):
+  address = str(tmpdir.join('aggregator.sock'))
+  tmpdir.ensure('node1', dir=True)
+  coordinator = start_daemon(tmpdir, 'coordinator', AGGREGATOR_LISTEN=address)
+  node = None
+  try:
+    # the node's watch expires soon, so its busy state has to reach a listening aggregator
+    deadline = time.time() + 10
+    while not os.path.exists(address) and time.time() < deadline:
+      time.sleep(0.1)
+    assert os.path.exists(address)
+    create_timeout_file(tmpdir, 'node1', int(time.time())-28)
+    node = start_daemon(tmpdir, 'node1', AGGREGATOR_ADDRESS=address, HEARTBEAT_INTERVAL='1')
+    assert node.wait(20) == 0
+    assert coordinator.wait(20) == 0
+  finally:
+    if node != None:
+      node.kill()
+    coordinator.kill()
+  assert tmpdir.join('node1.poweroff').exists()
+  assert tmpdir.join('coordinator.poweroff').exists()
+  assert 'Node node1 is busy' in tmpdir.join('coordinator.log').read()
+
+@pytest.mark.quick
+@pytest.mark.parametrize('allow,accepted', [('10.0.0.0/8', False), ('10.0.0.0/8, 127.0.0.0/8', True), ('127.0.0.1', True)])
+def test_allowed_networks(tmpdir, udp_coordinator, allow, accepted):
+  udp_coordinator.AGGREGATOR_ALLOW = allow
+  udp_coordinator.setup()
+  node = udp_node(tmpdir, udp_coordinator, 'node1')
+  node._report_state()
+  time.sleep(0.1)
+  udp_coordinator._process_node_messages()
+  assert ('node1' in udp_coordinator.node_hash) == accepted
+
+@pytest.mark.quick
+def test_listen_on_all_interfaces(udp_coordinator):
+  udp_coordinator.AGGREGATOR_LISTEN = ':0'
+  udp_coordinator.setup()
+  assert udp_coordinator.aggregator_socket.getsockname()[0] == '0.0.0.0'
+
+@pytest.mark.quick
+def test_listen_not_resolvable(udp_coordinator, caplog):
+  udp_coordinator.AGGREGATOR_LISTEN = 'nonexistent.invalid:7070'
+  with pytest.raises(OSError):
+    udp_coordinator.setup()
+  assert 'Invalid aggregator listen address' in caplog.text
+
+@pytest.mark.quick
+def test_allowed_networks_invalid(udp_coordinator):
+  udp_coordinator.AGGREGATOR_ALLOW = '127.0.0.0/8,not-a-network'
+  with pytest.raises(ValueError):
+    udp_coordinator.setup()
@@ -5,7 +5,7 @@ SCRIPT_DIR=$(realpath "$TEST_DIR/../source")
 export PYTHONPATH=$SCRIPT_DIR
 
 func=''
-files="${TEST_DIR}/basic_tests.py${func} ${TEST_DIR}/invalid_input.py${func}"
+files="${TEST_DIR}/basic_tests.py${func} ${TEST_DIR}/invalid_input.py${func} ${TEST_DIR}/aggregator_tests.py${func}"
 if (( $# > 0 ))
 then
 	if [[ -n ${1:-} ]]